@@ -19,12 +19,42 @@ class Dashboard {
             this.loadKPIs();
         });
 
-        // Actualización automática cada 5 minutos
+        // Actualizar cuando cambian los datos en el servidor
+        this.subscribeToUpdates(() => this.loadKPIs());
+    }
+
+    pollForUpdates(onChange) {
+        // Sin SSE: actualización automática cada 5 minutos
         setInterval(() => {
-            this.loadKPIs();
+            if (!document.hidden) {
+                onChange({});
+            }
         }, 300000);
     }
 
+    subscribeToUpdates(onChange) {
+        if (!window.EventSource) {
+            this.pollForUpdates(onChange);
+            return;
+        }
+
+        // El servidor avisa cuando terminó de recargar los datos; solo entonces se vuelve a pedir
+        this.eventSource = new EventSource('/api/stream');
+        this.eventSource.addEventListener('version', (event) => {
+            const data = JSON.parse(event.data);
+            if (this.dataVersion && this.dataVersion !== data.version) {
+                onChange(data);
+            }
+            this.dataVersion = data.version;
+        });
+        // Servidor sin conexiones libres (503): EventSource no reintenta, se pasa a consultar periódicamente
+        this.eventSource.addEventListener('error', () => {
+            if (this.eventSource.readyState === EventSource.CLOSED) {
+                this.pollForUpdates(onChange);
+            }
+        });
+    }
+
     async loadInitialData() {
         this.showLoading(true);
         await this.loadKPIs();
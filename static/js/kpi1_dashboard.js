@@ -41,12 +41,40 @@ class KPI1Dashboard {
             });
         }
 
-        // Auto-refresh
+        // Auto-refresh cuando cambian los datos en el servidor
+        this.subscribeToUpdates(() => this.loadAnalyticsData());
+    }
+
+    pollForUpdates(onChange) {
+        // Sin SSE: actualización automática cada 5 minutos
         setInterval(() => {
             if (!document.hidden) {
-                this.loadAnalyticsData();
+                onChange({});
             }
-        }, 300000); // 5 minutos
+        }, 300000);
+    }
+
+    subscribeToUpdates(onChange) {
+        if (!window.EventSource) {
+            this.pollForUpdates(onChange);
+            return;
+        }
+
+        // El servidor avisa cuando terminó de recargar los datos; solo entonces se vuelve a pedir
+        this.eventSource = new EventSource('/api/stream');
+        this.eventSource.addEventListener('version', (event) => {
+            const data = JSON.parse(event.data);
+            if (this.dataVersion && this.dataVersion !== data.version) {
+                onChange(data);
+            }
+            this.dataVersion = data.version;
+        });
+        // Servidor sin conexiones libres (503): EventSource no reintenta, se pasa a consultar periódicamente
+        this.eventSource.addEventListener('error', () => {
+            if (this.eventSource.readyState === EventSource.CLOSED) {
+                this.pollForUpdates(onChange);
+            }
+        });
     }
 
     setupChartControls() {
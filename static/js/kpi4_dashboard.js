@@ -9,8 +9,11 @@ class KPI4Dashboard {
 
     async init() {
         try {
-            await this.loadKPIData();
-            await this.loadAnalyticsData();
+            // KPI y análisis en una sola request
+            const response = await fetch('/api/batch?parts=kpis,kpi4');
+            const data = await response.json();
+            this.applyKPIData(data.kpis);
+            this.applyAnalyticsData(data.kpi4);
             this.hideLoading();
         } catch (error) {
             console.error('Error inicializando KPI 4 dashboard:', error);
@@ -18,37 +21,22 @@ class KPI4Dashboard {
         }
     }
 
-    async loadKPIData() {
-        try {
-            const response = await fetch('/api/kpis');
-            const data = await response.json();
-            
-            if (data.error) {
-                throw new Error(data.error);
-            }
-
-            const kpi4 = data.kpi4;
-            this.updateKPIDisplay(kpi4);
-        } catch (error) {
-            throw new Error(`Error cargando KPI: ${error.message}`);
+    applyKPIData(data) {
+        if (data.error) {
+            throw new Error(`Error cargando KPI: ${data.error}`);
         }
-    }
 
-    async loadAnalyticsData() {
-        try {
-            const response = await fetch('/api/kpi4/analytics');
-            const data = await response.json();
-            
-            if (data.error) {
-                throw new Error(data.error);
-            }
+        this.updateKPIDisplay(data.kpis.kpi_4);
+    }
 
-            this.currentData = data;
-            this.createCharts(data);
-            this.updateDetailedStats(data);
-        } catch (error) {
-            throw new Error(`Error cargando análisis: ${error.message}`);
+    applyAnalyticsData(data) {
+        if (data.error) {
+            throw new Error(`Error cargando análisis: ${data.error}`);
         }
+
+        this.currentData = data;
+        this.createCharts(data);
+        this.updateDetailedStats(data);
     }
 
     updateKPIDisplay(kpi) {
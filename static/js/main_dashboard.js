@@ -36,11 +36,18 @@ class MainDashboard {
     async loadInitialData() {
         this.showLoading(true);
         try {
-            await Promise.all([
-                this.loadKPIs(),
-                this.loadSummaryData(),
-                this.loadGlobalTrends()
-            ]);
+            // KPIs, resumen y tendencias en una sola request
+            const response = await fetch('/api/batch?parts=kpis,tendencias');
+            const data = await response.json();
+
+            if (data.error) {
+                this.showError(data.error);
+                return;
+            }
+
+            this.applyKPIs(data.kpis);
+            this.applySummaryData(data.kpis);
+            this.applyGlobalTrends(data.tendencias);
         } catch (error) {
             console.error('Error loading initial data:', error);
             this.showError('Error cargando datos iniciales');
@@ -68,17 +75,7 @@ class MainDashboard {
         try {
             const response = await fetch('/api/kpis');
             const data = await response.json();
-
-            if (data.error) {
-                this.showError(data.error);
-                return;
-            }
-
-            this.kpisData = data.kpis;
-            this.updateKPICards(data.kpis);
-            this.updateNavigationStatus(data.kpis);
-            this.updateLastUpdate(data.timestamp);
-            this.updateMiniCharts(data.kpis);
+            this.applyKPIs(data);
 
         } catch (error) {
             console.error('Error loading KPIs:', error);
@@ -86,32 +83,29 @@ class MainDashboard {
         }
     }
 
-    async loadSummaryData() {
-        try {
-            const response = await fetch('/api/kpis');
-            const data = await response.json();
-
-            if (data.error || !data.resumen) return;
-
-            this.updateSummaryStats(data.resumen);
-
-        } catch (error) {
-            console.error('Error loading summary:', error);
+    applyKPIs(data) {
+        if (data.error) {
+            this.showError(data.error);
+            return;
         }
+
+        this.kpisData = data.kpis;
+        this.updateKPICards(data.kpis);
+        this.updateNavigationStatus(data.kpis);
+        this.updateLastUpdate(data.timestamp);
+        this.updateMiniCharts(data.kpis);
     }
 
-    async loadGlobalTrends() {
-        try {
-            const response = await fetch('/api/tendencias');
-            const data = await response.json();
+    applySummaryData(data) {
+        if (data.error || !data.resumen) return;
 
-            if (data.error || !data.tendencias) return;
+        this.updateSummaryStats(data.resumen);
+    }
 
-            this.updateGlobalTrendsChart(data.tendencias);
+    applyGlobalTrends(data) {
+        if (data.error || !data.tendencias) return;
 
-        } catch (error) {
-            console.error('Error loading trends:', error);
-        }
+        this.updateGlobalTrendsChart(data.tendencias);
     }
 
     updateKPICards(kpis) {
@@ -530,13 +524,47 @@ class MainDashboard {
         }, 5000);
     }
 
-    setupAutoRefresh() {
-        // Actualización automática cada 5 minutos
+    pollForUpdates(onChange) {
+        // Sin SSE: actualización automática cada 5 minutos
         setInterval(() => {
             if (!document.hidden) {
-                this.loadKPIs();
+                onChange({});
             }
         }, 300000);
+    }
+
+    subscribeToUpdates(onChange) {
+        if (!window.EventSource) {
+            this.pollForUpdates(onChange);
+            return;
+        }
+
+        // El servidor avisa cuando terminó de recargar los datos; solo entonces se vuelve a pedir
+        this.eventSource = new EventSource('/api/stream?kpis=1');
+        this.eventSource.addEventListener('version', (event) => {
+            const data = JSON.parse(event.data);
+            if (this.dataVersion && this.dataVersion !== data.version) {
+                onChange(data);
+            }
+            this.dataVersion = data.version;
+        });
+        // Servidor sin conexiones libres (503): EventSource no reintenta, se pasa a consultar periódicamente
+        this.eventSource.addEventListener('error', () => {
+            if (this.eventSource.readyState === EventSource.CLOSED) {
+                this.pollForUpdates(onChange);
+            }
+        });
+    }
+
+    setupAutoRefresh() {
+        // Actualizar cuando cambian los datos; el evento ya trae los KPIs recalculados
+        this.subscribeToUpdates((data) => {
+            if (data.kpis) {
+                this.applyKPIs(data.kpis);
+            } else {
+                this.loadKPIs();
+            }
+        });
 
         // Recargar cuando la página vuelve a ser visible
         document.addEventListener('visibilitychange', () => {
@@ -4,9 +4,28 @@ Script para probar las optimizaciones del dashboard
 import sys
 import os
 import time
+import shutil
+import tempfile
+import io
+from datetime import timedelta
+import numpy as np
+import pandas as pd
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from app import DataCache, load_optimized_data, get_sample_data, calcular_kpi_1, calcular_kpi_2, calcular_kpi_3, calcular_kpi_4, calcular_kpi_5, calcular_kpi_6
+from app import HISLEC_TOTAL_SPEC, HISLEC_LIMPIO_SPEC, build_columnar_cache, load_columnar, dataset_version, reportar_memoria
+from app import identificar_lectura_estimada, clasificar_lecturas_estimadas
+from app import app, construir_cubo, consultar_cubo, calcular_kpis_exactos, QuantileSketch, SKETCH_ALPHA
+from app import calcular_tendencias_kpis, agregar_por_categoria, calcular_transiciones_continuidad, obtener_cubo
+from app import publicar_snapshot, leer_snapshot, guardar_respuesta_compartida, leer_respuesta_compartida
+from app import ResponseCache, clave_canonica, load_hislec_total, Precalentador, response_cache
+from app import registros_json, filtrar_hislec_limpio, difusor, notificar_cambio, columnas_derivadas, olvidar_snapshot
+from app import filtrar_rango_fechas, seleccionar_filas, parsear_fechas, ordenar_por_fecha
+from app import rangos_de_lineas, parse_unl_paralelo, _parse_unl
+import app as app_modulo
+
+DATA_TOTAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'hislec_total.unl')
+DATA_LIMPIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'hislec_limpio.unl')
 
 def test_data_loading():
     """Probar carga de datos optimizada"""
@@ -68,6 +87,1070 @@ def test_cache_system():
     speedup = first_load / cached_load if cached_load > 0 else float('inf')
     print(f"   ✓ Aceleración del caché: {speedup:.1f}x más rápido")
 
+def test_columnar_cache():
+    """Probar caché columnar de archivos .unl"""
+    print("\n=== PRUEBA DE CACHÉ COLUMNAR ===")
+    
+    start_time = time.time()
+    cache_dir, manifest = build_columnar_cache(DATA_TOTAL, **HISLEC_TOTAL_SPEC)
+    build_time = time.time() - start_time
+    print(f"   Caché construida: {manifest['rows']} registros en {build_time:.3f} segundos")
+    
+    start_time = time.time()
+    cache_dir_2, _ = build_columnar_cache(DATA_TOTAL, **HISLEC_TOTAL_SPEC)
+    print(f"   Caché reutilizada en {time.time() - start_time:.4f} segundos")
+    assert cache_dir == cache_dir_2
+    
+    columnas = ['numero_medidor', 'fecha_evento', 'lectura_terreno', 'vigente']
+    df = load_columnar(DATA_TOTAL, columnas, **HISLEC_TOTAL_SPEC)
+    original = pd.read_csv(DATA_TOTAL, delimiter='|', usecols=columnas, dtype=HISLEC_TOTAL_SPEC['dtypes'])
+    original['fecha_evento'] = pd.to_datetime(original['fecha_evento'], format='%d/%m/%Y', errors='coerce')
+    pd.testing.assert_frame_equal(df, original[columnas], check_categorical=False)
+    print(f"   ✓ Columnas leídas desde caché coinciden con read_csv: {columnas}")
+
+def test_dataset_version():
+    """Probar que la versión de los datos cambia solo cuando cambia el archivo"""
+    print("\n=== PRUEBA DE VERSIÓN DE DATOS ===")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'hislec_total.unl')
+        shutil.copy(DATA_TOTAL, path)
+        
+        version_1 = dataset_version(path)
+        assert dataset_version(path) == version_1
+        print(f"   Versión inicial: {version_1}")
+        
+        with open(DATA_TOTAL) as f:
+            ultima_linea = f.readlines()[-1]
+        with open(path, 'a') as f:
+            f.write(ultima_linea)
+        version_2 = dataset_version(path)
+        assert version_2 != version_1
+        print(f"   ✓ Versión tras agregar registros: {version_2}")
+
+def test_incremental_ingest():
+    """Probar ingesta incremental de registros agregados al final del archivo"""
+    print("\n=== PRUEBA DE INGESTA INCREMENTAL ===")
+    
+    with open(DATA_TOTAL) as f:
+        lineas = f.readlines()
+    mitad = len(lineas) // 2
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'hislec_total.unl')
+        with open(path, 'w') as f:
+            f.writelines(lineas[:mitad])
+        _, manifest = build_columnar_cache(path, **HISLEC_TOTAL_SPEC)
+        print(f"   Carga inicial: {manifest['rows']} registros")
+        
+        with open(path, 'a') as f:
+            f.writelines(lineas[mitad:])
+        _, manifest = build_columnar_cache(path, **HISLEC_TOTAL_SPEC)
+        assert len(manifest['segments']) == 2
+        print(f"   ✓ Tras agregar: {manifest['rows']} registros en {len(manifest['segments'])} segmentos")
+        
+        columnas = ['numero_medidor', 'fecha_evento', 'lectura_terreno', 'marca_medidor']
+        df = load_columnar(path, columnas, **HISLEC_TOTAL_SPEC)
+        original = pd.read_csv(path, delimiter='|', usecols=columnas, dtype=HISLEC_TOTAL_SPEC['dtypes'])
+        original['fecha_evento'] = pd.to_datetime(original['fecha_evento'], format='%d/%m/%Y', errors='coerce')
+        pd.testing.assert_frame_equal(df, original[columnas], check_categorical=False)
+        
+        with open(path, 'w') as f:
+            f.writelines(lineas[:100])
+        _, manifest = build_columnar_cache(path, **HISLEC_TOTAL_SPEC)
+        assert manifest['rows'] == 99 and len(manifest['segments']) == 1
+        print(f"   ✓ Archivo truncado reconstruido: {manifest['rows']} registros")
+
+def test_clasificador_estimadas():
+    """Probar que el clasificador vectorizado de KPI 3 coincide con la versión por fila"""
+    print("\n=== PRUEBA DE CLASIFICADOR DE LECTURAS ESTIMADAS ===")
+    
+    rng = np.random.default_rng(42)
+    n = 5000
+    observaciones = [np.nan, '', 'lectura normal', 'Consumo ESTIMADO', 'promedio', 'sin lectura', 'CALCULADA', 'imputada']
+    df = pd.DataFrame({
+        'med_ficticio': pd.Categorical(rng.choice(['S', 'N', np.nan], n, p=[0.05, 0.8, 0.15])),
+        'lectura_terreno': rng.choice([np.nan, 0.0, 10.5, 250.0], n, p=[0.1, 0.1, 0.4, 0.4]),
+        'obs_verificada': rng.choice(np.array(observaciones, dtype=object), n),
+        'obs_inicial': rng.choice(np.array(observaciones, dtype=object), n),
+        'clave_lectura_act': rng.choice(np.array(['N', 'est', 'PROM', np.nan], dtype=object), n)
+    })
+    
+    start_time = time.time()
+    esperado = df.apply(identificar_lectura_estimada, axis=1)
+    fila_time = time.time() - start_time
+    
+    start_time = time.time()
+    es_estimada, motivo = clasificar_lecturas_estimadas(df)
+    vector_time = time.time() - start_time
+    
+    assert es_estimada.tolist() == [e[0] for e in esperado]
+    assert motivo.astype(str).tolist() == [e[1] for e in esperado]
+    print(f"   ✓ {n} registros clasificados igual: por fila {fila_time:.3f}s, vectorizado {vector_time:.4f}s")
+
+def _transiciones_por_medidor(df):
+    """Versión anterior de KPI 6 (un loop por medidor, sin muestreo ni tope de medidores):
+    conteos de transiciones e inconsistencias por mes de la lectura posterior"""
+    conteos = {}
+    df_sorted = df.sort_values(['numero_medidor', 'fecha_evento'])
+    for medidor in df_sorted['numero_medidor'].unique():
+        medidor_data = df_sorted[df_sorted['numero_medidor'] == medidor]
+        if len(medidor_data) < 2:
+            continue
+        lecturas = medidor_data['lectura_actual'].values
+        fechas = medidor_data['fecha_evento'].values
+        for i in range(len(lecturas) - 1):
+            if pd.isna(lecturas[i]) or pd.isna(lecturas[i + 1]):
+                continue
+            mes = pd.Timestamp(fechas[i + 1]).to_period('M')
+            total, inconsistentes = conteos.get(mes, (0, 0))
+            inconsistente = lecturas[i] == lecturas[i + 1] and lecturas[i] > 0
+            if not inconsistente and lecturas[i] > 0 and lecturas[i + 1] > 0:
+                inconsistente = abs(lecturas[i + 1] - lecturas[i]) / lecturas[i] > 2.0
+            conteos[mes] = (total + 1, inconsistentes + int(inconsistente))
+    return conteos
+
+def test_continuidad_kpi6():
+    """Probar las transiciones vectorizadas de KPI 6 contra el loop por medidor"""
+    print("\n=== PRUEBA DE CONTINUIDAD (KPI 6) ===")
+    
+    rng = np.random.default_rng(6)
+    medidores, dias = [], []
+    for medidor in range(300):
+        n = 1 if medidor % 50 == 0 else int(rng.integers(2, 15))  # Algunos medidores con una sola lectura
+        medidores.append(np.full(n, 700000 + medidor))
+        dias.append(rng.choice(400, n, replace=False))  # Fechas distintas, en cualquier orden
+    medidores, dias = np.concatenate(medidores), np.concatenate(dias)
+    df = pd.DataFrame({
+        'numero_medidor': medidores,
+        'fecha_evento': pd.Timestamp('2024-01-01') + pd.to_timedelta(dias, unit='D'),
+        'lectura_actual': rng.choice([np.nan, 0.0, 100.0, 250.0, 900.0, 5000.0], len(dias),
+                                     p=[0.1, 0.1, 0.3, 0.2, 0.2, 0.1])
+    })
+    df = df.sample(frac=1, random_state=6).reset_index(drop=True)  # Registros fuera de orden
+    
+    esperado = _transiciones_por_medidor(df)
+    transiciones = calcular_transiciones_continuidad(df)
+    mensual = transiciones.groupby(transiciones['fecha_evento'].dt.to_period('M'))[['transicion', 'inconsistente']].sum()
+    obtenido = {mes: (int(fila['transicion']), int(fila['inconsistente']))
+                for mes, fila in mensual.iterrows() if fila['transicion'] > 0}
+    assert obtenido == esperado
+    
+    total = sum(t for t, _ in esperado.values())
+    inconsistentes = sum(i for _, i in esperado.values())
+    assert calcular_kpi_6(df)['valor'] == round((1 - inconsistentes / total) * 100, 2)
+    print(f"   ✓ {total} transiciones y {inconsistentes} inconsistencias iguales al loop por medidor, en {len(esperado)} meses")
+
+def test_cubo_mensual():
+    """Probar que las consultas al cubo coinciden con agregar los registros directamente"""
+    print("\n=== PRUEBA DE CUBO MENSUAL ===")
+    
+    rng = np.random.default_rng(7)
+    n = 20000
+    df = pd.DataFrame({
+        'fecha_evento': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n), unit='D'),
+        'segmento': rng.choice(np.array(['RESIDENCIAL', 'COMERCIAL', 'INDUSTRIAL'], dtype=object), n),
+        'marca_medidor': rng.choice(np.array(['ABB', 'ITRON', 'SIEMENS', np.nan], dtype=object), n),
+        'ubicacion': rng.choice(np.array(['URB-01', 'RES-02', 'IND-03', np.nan], dtype=object), n),
+        'consumo_teorico': rng.choice([0.0, 100.0, 250.0, 1200.0], n),
+        'consumo_reportado': rng.uniform(-10, 1500, n),
+        'tipo_lectura': rng.choice(np.array(['REAL', 'ESTIMADA'], dtype=object), n),
+        'evento': rng.choice(np.array(['L', 'R'], dtype=object), n, p=[0.95, 0.05])
+    })
+    
+    cubo = construir_cubo('hislec_limpio', df)
+    assert len(cubo['datos']) < len(df)
+    
+    validos = (df['consumo_teorico'] > 0) & (df['consumo_reportado'] >= 0)
+    df_valid = df[validos]
+    atipicos = (df_valid['consumo_reportado'] - df_valid['consumo_teorico']).abs() / df_valid['consumo_teorico'] >= 0.3
+    esperado = (atipicos.groupby(df_valid['segmento']).mean() * 100)
+    
+    resultado = consultar_cubo(cubo, ['segmento'], ['validos', 'tasa_atipica']).set_index('segmento')
+    for segmento, tasa in esperado.items():
+        assert abs(resultado.loc[segmento, 'tasa_atipica'] - tasa) < 1e-9
+    
+    resultado = consultar_cubo(cubo, ['mes'], ['registros', 'reclamos'], {'marca_medidor': ['ABB']}, '2024-03', '2024-05')
+    df_abb = df[(df['marca_medidor'] == 'ABB') & df['fecha_evento'].between('2024-03-01', '2024-05-31')]
+    assert resultado['mes'].tolist() and set(resultado['mes']) <= {'2024-03', '2024-04', '2024-05'}
+    assert resultado['registros'].sum() == len(df_abb)
+    assert resultado['reclamos'].sum() == (df_abb['evento'] == 'R').sum()
+    
+    respuesta = app.test_client().get('/api/pivot?dims=mes&measures=no_existe')
+    assert respuesta.status_code == 400
+    for qs in ('1.5', '-0.1', 'nan', '0.5|2'):
+        respuesta = app.test_client().get(f'/api/pivot?percentiles=divergencia:{qs}')
+        assert respuesta.status_code == 400 and f'divergencia:{qs}' in respuesta.get_json()['error']
+    print(f"   ✓ Cubo de {len(cubo['datos'])} celdas coincide con {n} registros")
+
+def test_kpis_exactos():
+    """Probar que el modo exacto por tramos coincide con el cálculo sobre el DataFrame completo"""
+    print("\n=== PRUEBA DE KPIs EXACTOS POR TRAMOS ===")
+    
+    rng = np.random.default_rng(11)
+    n = 7000  # Bajo los umbrales de muestreo: ambos cálculos usan todos los registros
+    df = pd.DataFrame({
+        'consumo_teorico': rng.choice([0.0, np.nan, 100.0, 250.0, 1200.0], n).astype('float32'),
+        'consumo_reportado': rng.uniform(-10, 1500, n).astype('float32'),
+        'tipo_lectura': pd.Categorical(rng.choice(['REAL', 'ESTIMADA'], n, p=[0.9, 0.1])),
+        'evento': rng.choice(np.array(['L', 'R'], dtype=object), n, p=[0.99, 0.01])
+    })
+    
+    esperado = {
+        'kpi_1': calcular_kpi_1(df), 'kpi_2': calcular_kpi_2(df), 'kpi_3': calcular_kpi_3(df),
+        'kpi_4': calcular_kpi_4(df), 'kpi_5': calcular_kpi_5(df)
+    }
+    for filas in (len(df), 997):
+        exactos = calcular_kpis_exactos(df, filas=filas)
+        for kpi, resultado in esperado.items():
+            if kpi == 'kpi_4':
+                # El umbral de morosidad del modo exacto sale de un sketch de cuantiles (error relativo 1%)
+                assert abs(exactos[kpi]['valor'] - resultado['valor']) < 1.0, (filas, exactos[kpi], resultado)
+            else:
+                assert exactos[kpi] == resultado, (kpi, filas, exactos[kpi], resultado)
+    print(f"   ✓ KPIs 1-5 por tramos iguales al cálculo directo: {esperado['kpi_1']['valor']}% atípicas")
+
+def test_cifras_desde_cubo():
+    """Probar que las cifras principales de KPI 1 y KPI 4 salen de la población completa del cubo"""
+    print("\n=== PRUEBA DE CIFRAS PRINCIPALES DESDE EL CUBO ===")
+    
+    # Historia completa: el archivo de prueba queda fuera de la ventana de 12 meses
+    configuracion = (app_modulo.HISTORIA_DIAS, app_modulo.data_cache)
+    app_modulo.HISTORIA_DIAS, app_modulo.data_cache = 0, DataCache()
+    response_cache.invalidate(None)
+    try:
+        client = app.test_client()
+        cubo = obtener_cubo('hislec_limpio', load_optimized_data())
+        t = consultar_cubo(cubo, [], ['validos', 'atipicos', 'suma_divergencia']).iloc[0]
+        
+        kpi1 = client.get('/api/kpi1/analytics').get_json()['kpi_principal']
+        assert kpi1['total_facturas'] == t['validos'] and kpi1['facturas_atipicas'] == t['atipicos']
+        
+        primera = client.get('/api/kpi4/analytics').get_json()
+        stats = primera['stats']
+        assert stats['total_medidores'] == t['validos'] and stats['medidores_atipicos'] == t['atipicos']
+        assert stats['divergencia_promedio'] == round(float(t['suma_divergencia'] / t['validos']) * 100, 2)
+        assert 'stats.correlacion' in primera['muestra']['campos']
+        
+        # Sin aleatoriedad sin semilla: recalcular (sin la caché de respuestas) devuelve lo mismo
+        with app.test_request_context('/api/kpi4/analytics'):
+            segunda = app_modulo.api_kpi4_analytics.__wrapped__().get_json()
+        assert segunda['factores_riesgo'] == primera['factores_riesgo']
+        assert segunda['correlacion_data'] == primera['correlacion_data']
+    finally:
+        app_modulo.HISTORIA_DIAS, app_modulo.data_cache = configuracion
+        response_cache.invalidate(None)
+    print(f"   ✓ {kpi1['facturas_atipicas']}/{kpi1['total_facturas']} atípicas en KPI 1 y KPI 4, iguales al cubo")
+
+def test_quantile_sketch():
+    """Probar que los sketches combinados por partición dan cuantiles con error relativo acotado"""
+    print("\n=== PRUEBA DE SKETCHES DE CUANTILES ===")
+    
+    rng = np.random.default_rng(3)
+    valores = np.concatenate([np.zeros(500), rng.lognormal(3, 2, 200000)])
+    rng.shuffle(valores)
+    
+    completo = QuantileSketch().add(valores)
+    combinado = QuantileSketch()
+    for particion in np.array_split(valores, 12):
+        combinado.merge(QuantileSketch().add(particion))
+    assert combinado.counts.sort_index().equals(completo.counts.sort_index())
+    
+    for q in (0.0, 0.5, 0.8, 0.9, 0.95, 0.99):
+        exacto = np.quantile(valores, q)
+        aproximado = combinado.quantile(q)
+        assert abs(aproximado - exacto) <= SKETCH_ALPHA * exacto + 1e-12, (q, aproximado, exacto)
+    assert np.isnan(QuantileSketch().quantile(0.5))
+    print(f"   ✓ {len(valores)} valores en {len(combinado.counts)} bins, p95 = {combinado.quantile(0.95):.2f}")
+
+def test_tendencias_una_pasada():
+    """Probar que la serie mensual desde el cubo coincide con calcular los KPIs mes a mes"""
+    print("\n=== PRUEBA DE TENDENCIAS EN UNA PASADA ===")
+    
+    rng = np.random.default_rng(5)
+    n = 6000
+    df = pd.DataFrame({
+        'numero_medidor': rng.integers(1, 300, n),
+        'fecha_evento': pd.Timestamp('2023-06-01') + pd.to_timedelta(rng.integers(0, 540, n), unit='D'),
+        'lectura_actual': rng.uniform(0, 5000, n),
+        'segmento': rng.choice(np.array(['RESIDENCIAL', 'COMERCIAL'], dtype=object), n),
+        'marca_medidor': rng.choice(np.array(['ABB', 'ITRON'], dtype=object), n),
+        'ubicacion': rng.choice(np.array(['URB-01', 'RES-02'], dtype=object), n),
+        'consumo_teorico': rng.choice([0.0, 100.0, 250.0, 1200.0], n),
+        'consumo_reportado': rng.uniform(-10, 1500, n),
+        'tipo_lectura': rng.choice(np.array(['REAL', 'ESTIMADA'], dtype=object), n),
+        'evento': rng.choice(np.array(['L', 'R'], dtype=object), n, p=[0.9, 0.1])
+    })
+    
+    start_time = time.time()
+    tendencias = calcular_tendencias_kpis(df, cubo=construir_cubo('hislec_limpio', df))
+    print(f"   Tendencias calculadas en {time.time() - start_time:.3f}s")
+    
+    assert len(tendencias) == 12
+    meses = df['fecha_evento'].dt.strftime('%Y-%m')
+    for fila in tendencias:
+        df_mes = df[meses == fila['mes']]
+        assert fila['kpi_1'] == calcular_kpi_1(df_mes)['valor']
+        assert fila['kpi_2'] == calcular_kpi_2(df_mes)['valor']
+        assert fila['kpi_3'] == calcular_kpi_3(df_mes)['valor']
+        assert fila['kpi_5'] == calcular_kpi_5(df_mes)['valor']
+        assert 0 <= fila['kpi_4'] <= 100
+    print(f"   ✓ {len(tendencias)} meses iguales al cálculo mes a mes")
+
+def test_agregar_por_categoria():
+    """Probar la agregación agrupada contra el recorrido por categoría con máscaras"""
+    print("\n=== PRUEBA DE AGREGACIÓN POR CATEGORÍA ===")
+    
+    rng = np.random.default_rng(9)
+    n = 50000
+    contratistas = np.array([f'C{i:03d}' for i in range(300)] + [np.nan], dtype=object)
+    df = pd.DataFrame({
+        'cod_contratista': rng.choice(contratistas, n),
+        'es_estimada': rng.random(n) < 0.1
+    })
+    
+    start_time = time.time()
+    esperado = {}
+    for contratista in df['cod_contratista'].unique():
+        if pd.isna(contratista):
+            continue
+        df_contr = df[df['cod_contratista'] == contratista]
+        esperado[contratista] = (len(df_contr), int(df_contr['es_estimada'].sum()))
+    mascaras_time = time.time() - start_time
+    
+    start_time = time.time()
+    resultado = agregar_por_categoria(
+        df, 'cod_contratista', ['es_estimada'], {'porcentaje': ('es_estimada', 'total', 100)}
+    )
+    agrupado_time = time.time() - start_time
+    
+    assert list(resultado.index) == list(esperado)  # Orden de aparición, sin nulos
+    assert {k: (int(t), int(e)) for k, t, e in zip(resultado.index, resultado['total'], resultado['es_estimada'])} == esperado
+    
+    top = agregar_por_categoria(df, 'cod_contratista', ['es_estimada'], {'porcentaje': ('es_estimada', 'total', 100)},
+                                ordenar_por='porcentaje', top=5)
+    assert top['porcentaje'].is_monotonic_decreasing and len(top) == 5
+    
+    primeros = agregar_por_categoria(df, 'cod_contratista', primeros=10)
+    assert len(primeros) == 10 - int(pd.isna(df['cod_contratista'].unique()[:10]).sum())
+    print(f"   ✓ 300 contratistas: máscaras {mascaras_time:.3f}s, agrupado {agrupado_time:.4f}s")
+
+def test_cache_compartida():
+    """Probar el snapshot compartido entre workers (memory-mapped) y el almacén de respuestas"""
+    print("\n=== PRUEBA DE CACHÉ COMPARTIDA ENTRE WORKERS ===")
+    
+    df = load_columnar(DATA_TOTAL, ['numero_medidor', 'fecha_evento', 'lectura_terreno', 'marca_medidor'],
+                       **HISLEC_TOTAL_SPEC)
+    df['marca_medidor'] = df['marca_medidor'].astype(object)
+    configuracion = (app_modulo.SHARED_CACHE, app_modulo.SHARED_CACHE_DIR)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app_modulo.SHARED_CACHE, app_modulo.SHARED_CACHE_DIR = True, tmp_dir
+        try:
+            assert leer_snapshot('hislec_total', DATA_TOTAL, 'v1') is None
+            publicar_snapshot('hislec_total', DATA_TOTAL, 'v1', df, {'generation': 'gen-1', 'rows': len(df)})
+            mapeado, estado = leer_snapshot('hislec_total', DATA_TOTAL, 'v1')
+            pd.testing.assert_frame_equal(mapeado, df)
+            assert estado['rows'] == len(df)
+            
+            # Las columnas numéricas son vistas de solo lectura sobre el archivo, no copias por worker
+            lecturas = mapeado['lectura_terreno'].to_numpy()
+            assert not lecturas.flags.writeable and isinstance(lecturas.base, np.memmap)
+            assert leer_snapshot('hislec_total', DATA_TOTAL, 'v2') is None
+            print(f"   ✓ Snapshot de {len(mapeado)} registros mapeado sin copiar")
+            
+            with app.test_request_context():
+                guardar_respuesta_compartida('v1', 'api_kpis_[]', ({'valor': 1.5}, 200))
+                respuesta = leer_respuesta_compartida('v1', 'api_kpis_[]', timeout=60)
+            assert respuesta.status_code == 200 and respuesta.get_json() == {'valor': 1.5}
+            assert leer_respuesta_compartida('v2', 'api_kpis_[]') is None
+            assert leer_respuesta_compartida('v1', 'api_kpis_[]', timeout=0) is None
+            print("   ✓ Respuesta compartida recuperada desde disco con su status")
+            
+            # Los errores (status distinto de 200 o cuerpo con 'error') no se comparten
+            with app.test_request_context():
+                guardar_respuesta_compartida('v1', 'api_kpi1_[]', ({'error': 'sin datos'}, 500))
+                guardar_respuesta_compartida('v1', 'api_kpi4_[]', {'error': 'sin datos'})
+            assert leer_respuesta_compartida('v1', 'api_kpi1_[]') is None
+            assert leer_respuesta_compartida('v1', 'api_kpi4_[]') is None
+            print("   ✓ Respuestas de error no compartidas")
+        finally:
+            app_modulo.SHARED_CACHE, app_modulo.SHARED_CACHE_DIR = configuracion
+
+def test_response_cache():
+    """Probar la caché de respuestas: LRU, TTL, presupuesto en bytes, single-flight y claves canónicas"""
+    print("\n=== PRUEBA DE CACHÉ DE RESPUESTAS ===")
+    import threading
+    
+    cache = ResponseCache(max_entries=3, max_bytes=1000)
+    cache.invalidate('v1')
+    for i in range(4):
+        cache.get_or_compute(f'k{i}', lambda i=i: {'valor': i})
+    assert list(cache.entries) == ['k1', 'k2', 'k3'] and cache.evictions == 1
+    cache.get_or_compute('k1', lambda: None)  # hit: k1 pasa a ser la más reciente
+    cache.get_or_compute('k4', lambda: {'valor': 4})
+    assert list(cache.entries) == ['k3', 'k1', 'k4']
+    
+    cache.get_or_compute('grande', lambda: {'datos': 'x' * 600})
+    cache.get_or_compute('grande2', lambda: {'datos': 'y' * 600})
+    assert 'grande' not in cache.entries and cache.bytes <= 1000
+    
+    cache.get_or_compute('ttl', lambda: {'valor': 1}, ttl=0.05)
+    time.sleep(0.06)
+    assert cache.get_or_compute('ttl', lambda: {'valor': 2}, ttl=0.05) == {'valor': 2}
+    assert cache.expirations == 1
+    
+    # 8 requests concurrentes con la misma clave: un solo cálculo
+    llamadas = []
+    def lento():
+        llamadas.append(1)
+        time.sleep(0.1)
+        return {'valor': 'lento'}
+    resultados = []
+    threads = [threading.Thread(target=lambda: resultados.append(cache.get_or_compute('lento', lento)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(llamadas) == 1 and resultados == [{'valor': 'lento'}] * 8
+    print(f"   ✓ Estadísticas: {cache.stats()}")
+    
+    assert cache.invalidate('v2') and not cache.entries
+    
+    base = clave_canonica('api_kpis', {})
+    assert clave_canonica('api_kpis', {'segmento': ''}) == base
+    assert clave_canonica('api_kpis', {'exact': '0'}) == base
+    # Los handlers filtran con el valor sin recortar: 'RESIDENCIAL ' no es 'RESIDENCIAL'
+    assert clave_canonica('api_kpis', {'segmento': 'RESIDENCIAL '}) != clave_canonica('api_kpis', {'segmento': 'RESIDENCIAL'})
+    assert clave_canonica('api_kpis', {'exact': ' 1'}) == base
+    assert (clave_canonica('api_kpis', {'segmento': 'A', 'fecha_fin': '2024-01-01'}) ==
+            clave_canonica('api_kpis', {'fecha_fin': '2024-01-01', 'segmento': 'A'}))
+    assert (clave_canonica('api_kpi1', {'umbral_divergencia': '0.3'}, {'umbral_divergencia': 0.30}) ==
+            clave_canonica('api_kpi1', {}, {'umbral_divergencia': 0.30}))
+    print("   ✓ Claves canónicas: orden, vacíos y valores por defecto")
+    
+    # Un error no queda en caché: la request siguiente vuelve a calcular
+    llamadas = []
+    def fallido():
+        llamadas.append(1)
+        return {'error': 'sin datos'}
+    no_error = lambda resultado: 'error' not in resultado
+    for _ in range(2):
+        assert cache.get_or_compute('fallido', fallido, cacheable=no_error) == {'error': 'sin datos'}
+    assert len(llamadas) == 2 and 'fallido' not in cache.entries
+    
+    with app.test_request_context():
+        assert app_modulo.respuesta_cacheable(app.make_response({'valor': 1}))
+        assert not app_modulo.respuesta_cacheable(app.make_response({'error': 'sin datos'}))
+        assert not app_modulo.respuesta_cacheable(app.make_response(({'valor': 1}, 500)))
+    print("   ✓ Errores entregados sin guardarse en la caché")
+
+def test_recarga_snapshots():
+    """Probar la recarga en segundo plano: se sirve el snapshot anterior hasta publicar el nuevo"""
+    print("\n=== PRUEBA DE RECARGA CON SNAPSHOTS INMUTABLES ===")
+    
+    with open(DATA_TOTAL) as f:
+        lineas = f.readlines()
+    mitad = len(lineas) // 2
+    
+    configuracion = (app_modulo.DATA_PATHS_TOTAL, app_modulo.data_cache)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'hislec_total.unl')
+        with open(path, 'w') as f:
+            f.writelines(lineas[:mitad])
+        app_modulo.DATA_PATHS_TOTAL = [path]
+        app_modulo.data_cache = DataCache()
+        try:
+            anterior = load_hislec_total()
+            filas_anterior = len(anterior)
+            
+            with open(path, 'a') as f:
+                f.writelines(lineas[mitad:])
+            
+            # La request que detecta el cambio no espera la recarga
+            assert load_hislec_total() is anterior
+            for _ in range(100):
+                if not app_modulo.data_cache.reloading:
+                    break
+                time.sleep(0.05)
+            nuevo = load_hislec_total()
+            assert nuevo is not anterior and len(nuevo) == len(lineas) - 1
+            assert len(anterior) == filas_anterior  # El snapshot anterior no se modificó
+            print(f"   ✓ Snapshot {filas_anterior} → {len(nuevo)} registros sin bloquear lectores")
+            
+            # Una request que empezó con el snapshot anterior sigue leyendo el cubo de ese snapshot
+            cubo_anterior = obtener_cubo('hislec_total', anterior)
+            pd.testing.assert_frame_equal(cubo_anterior['datos'], construir_cubo('hislec_total', anterior)['datos'])
+            cubo_nuevo = obtener_cubo('hislec_total', nuevo)
+            assert cubo_nuevo['datos']['registros'].sum() > cubo_anterior['datos']['registros'].sum()
+            assert obtener_cubo('hislec_total', anterior) is cubo_anterior
+            print("   ✓ Cubo construido sobre el snapshot de cada request")
+        finally:
+            app_modulo.DATA_PATHS_TOTAL, app_modulo.data_cache = configuracion
+
+def test_ventana_historia():
+    """Probar que la ventana de HISTORIA_DIAS se aplica a todo el snapshot y avanza con la fecha"""
+    print("\n=== PRUEBA DE VENTANA DE HISTORIA ===")
+    
+    with open(DATA_LIMPIO) as f:
+        lineas = f.read().splitlines(keepends=False)
+    encabezado, filas = lineas[0], lineas[1:]
+    mitad = len(filas) // 2
+    
+    class Reloj(app_modulo.datetime):
+        ahora = app_modulo.datetime(2025, 1, 1, 10, 30)
+        @classmethod
+        def now(cls, tz=None):
+            return cls.ahora
+    
+    def esperado():
+        df = pd.read_csv(path, usecols=['fecha_evento'])
+        fechas = pd.to_datetime(df['fecha_evento'], format='%d/%m/%Y', errors='coerce')
+        return int((fechas > pd.Timestamp(Reloj.ahora.date() - timedelta(days=365))).sum())
+    
+    configuracion = (app_modulo.DATA_PATHS, app_modulo.data_cache, app_modulo.HISTORIA_DIAS, app_modulo.datetime)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'hislec_limpio.unl')
+        with open(path, 'w') as f:
+            f.write('\n'.join([encabezado] + filas[:mitad]) + '\n')
+        app_modulo.DATA_PATHS, app_modulo.data_cache = [path], DataCache()
+        app_modulo.HISTORIA_DIAS, app_modulo.datetime = 365, Reloj
+        try:
+            inicial = app_modulo._recargar('hislec_limpio')
+            assert len(inicial.data) == esperado()
+            
+            # Los registros ya cargados también quedan sujetos al corte tras una ingesta incremental
+            with open(path, 'a') as f:
+                f.write('\n'.join(filas[mitad:]) + '\n')
+            Reloj.ahora += timedelta(days=90)
+            agregado = app_modulo._recargar('hislec_limpio')
+            assert agregado.rows > inicial.rows and len(agregado.data) == esperado()
+            corte = pd.Timestamp(Reloj.ahora.date() - timedelta(days=365))
+            assert agregado.data['fecha_evento'].min() > corte
+            print(f"   ✓ Ingesta incremental recortada a la ventana: {len(agregado.data)} registros")
+            
+            # Sin cambios en el archivo, el cambio de día basta para recargar y mover la ventana
+            assert agregado.is_current()
+            Reloj.ahora += timedelta(days=90)
+            assert not agregado.is_current()
+            movido = app_modulo._recargar('hislec_limpio')
+            assert movido.rows == agregado.rows and len(movido.data) == esperado()
+            assert len(movido.data) < len(agregado.data) and movido.epoch > agregado.epoch
+            assert app_modulo.data_version_key().split('|')[0] == movido.version
+            print(f"   ✓ Ventana avanzada sin cambios en el archivo: {len(movido.data)} registros")
+        finally:
+            (app_modulo.DATA_PATHS, app_modulo.data_cache,
+             app_modulo.HISTORIA_DIAS, app_modulo.datetime) = configuracion
+
+def test_stale_while_revalidate():
+    """Probar que tras un cambio de datos se sirve la respuesta anterior mientras se recalcula"""
+    print("\n=== PRUEBA DE STALE-WHILE-REVALIDATE Y PRECALENTAMIENTO ===")
+    import threading
+    
+    cache = ResponseCache()
+    cache.invalidate('v1')
+    cache.get_or_compute('api_kpis_[]', lambda: {'version': 1})
+    cache.invalidate('v2')
+    
+    listo = threading.Event()
+    def recalcular():
+        time.sleep(0.05)
+        listo.set()
+        return {'version': 2}
+    start_time = time.time()
+    assert cache.get_or_compute('api_kpis_[]', recalcular, background=recalcular) == {'version': 1}
+    assert time.time() - start_time < 0.05
+    listo.wait(1)
+    for _ in range(100):
+        if 'api_kpis_[]' in cache.entries:
+            break
+        time.sleep(0.01)
+    assert cache.get_or_compute('api_kpis_[]', recalcular, background=recalcular) == {'version': 2}
+    assert cache.stale_hits == 1 and not cache.stale
+    print(f"   ✓ Respuesta anterior servida mientras se recalculaba: {cache.stats()}")
+    
+    # Historia completa: fuera de la ventana de 12 meses la respuesta es un error, que no se guarda
+    configuracion = (app_modulo.HISTORIA_DIAS, app_modulo.data_cache)
+    app_modulo.HISTORIA_DIAS, app_modulo.data_cache = 0, DataCache()
+    try:
+        Precalentador(0, ['/api/tendencias']).calentar()
+        assert 'api_tendencias_[]' in response_cache.entries
+    finally:
+        app_modulo.HISTORIA_DIAS, app_modulo.data_cache = configuracion
+        response_cache.invalidate(None)
+    print("   ✓ Precalentador calculó la respuesta por defecto de /api/tendencias")
+
+def test_etag_condicional():
+    """Probar ETag y 304 Not Modified en los endpoints /api"""
+    print("\n=== PRUEBA DE ETAG Y GET CONDICIONAL ===")
+    
+    client = app.test_client()
+    primera = client.get('/api/tendencias')
+    etag = primera.headers.get('ETag')
+    assert primera.status_code == 200 and etag
+    
+    misses = response_cache.misses
+    segunda = client.get('/api/tendencias', headers={'If-None-Match': etag})
+    assert segunda.status_code == 304 and segunda.data == b'' and segunda.headers['ETag'] == etag
+    assert response_cache.misses == misses
+    
+    # Mismos filtros canónicos, mismo ETag; filtros distintos, ETag distinto
+    assert client.get('/api/kpis?segmento=').headers['ETag'] == client.get('/api/kpis').headers['ETag']
+    assert client.get('/api/kpis?segmento=X').headers['ETag'] != client.get('/api/kpis').headers['ETag']
+    rellenado = client.get('/api/kpis?segmento=RESIDENCIAL%20')
+    assert rellenado.headers['ETag'] != client.get('/api/kpis?segmento=RESIDENCIAL').headers['ETag']
+    print(f"   ✓ 304 con ETag {etag} sin recalcular")
+    
+    # Los contadores de la caché son en vivo: sin ETag y sin guardarse en proxies
+    stats = client.get('/api/cache/stats')
+    assert stats.headers['Cache-Control'] == 'no-store' and 'ETag' not in stats.headers
+
+def test_json_comprimido():
+    """Probar serialización de tipos NumPy, registros en bloque y compresión gzip negociada"""
+    print("\n=== PRUEBA DE JSON RÁPIDO Y COMPRESIÓN ===")
+    import gzip
+    import json
+    
+    with app.app_context():
+        cuerpo = app.json.dumps({'n': np.int64(3), 'v': np.arange(3), 'ok': np.bool_(True)})
+    assert json.loads(cuerpo) == {'n': 3, 'v': [0, 1, 2], 'ok': True}
+    
+    assert registros_json(a=np.array([1, 2]), b=pd.Series(['x', 'y'])) == [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}]
+    
+    client = app.test_client()
+    plano = client.get('/api/kpi6/analytics')
+    comprimido = client.get('/api/kpi6/analytics', headers={'Accept-Encoding': 'gzip'})
+    assert comprimido.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in comprimido.headers['Vary']
+    assert gzip.decompress(comprimido.data) == plano.data
+    assert comprimido.headers['ETag'] == plano.headers['ETag'][:-1] + '-gzip"'
+    
+    # La respuesta en caché no quedó comprimida (ni con sus headers) para los clientes sin gzip
+    despues = client.get('/api/kpi6/analytics')
+    assert despues.data == plano.data and 'Content-Encoding' not in despues.headers
+    assert despues.headers['ETag'] == plano.headers['ETag']
+    otra_vez = client.get('/api/kpi6/analytics', headers={'Accept-Encoding': 'gzip'})
+    assert otra_vez.headers['Content-Encoding'] == 'gzip' and gzip.decompress(otra_vez.data) == plano.data
+    no_modificado = client.get('/api/kpi6/analytics', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': comprimido.headers['ETag']})
+    assert no_modificado.status_code == 304
+    print(f"   ✓ /api/kpi6/analytics: {len(plano.data)} bytes → {len(comprimido.data)} bytes con gzip")
+    
+    # Con brotli instalado (requirements.txt) se prefiere br; el cuerpo se descomprime igual
+    if app_modulo.brotli is not None:
+        br = client.get('/api/kpi6/analytics', headers={'Accept-Encoding': 'gzip, br'})
+        assert br.headers['Content-Encoding'] == 'br' and app_modulo.brotli.decompress(br.data) == plano.data
+        print(f"   ✓ brotli: {len(br.data)} bytes")
+    
+    # Con orjson instalado (requirements.txt) las respuestas equivalen a las de json estándar
+    if app_modulo.orjson is not None:
+        configuracion = (app_modulo.HISTORIA_DIAS, app_modulo.data_cache, app_modulo.orjson)
+        app_modulo.HISTORIA_DIAS, app_modulo.data_cache = 0, DataCache()
+        try:
+            for ruta, vista in (('/api/kpi2/analytics', app_modulo.api_kpi2_analytics),
+                                ('/api/kpi6/analytics', app_modulo.api_kpi6_analytics),
+                                ('/api/pivot?dims=mes,segmento&measures=registros,tasa_atipica&percentiles=divergencia:0.5',
+                                 app_modulo.api_pivot)):
+                cuerpos = []
+                for serializador in (configuracion[2], None):
+                    app_modulo.orjson = serializador
+                    with app.test_request_context(ruta):
+                        cuerpo = json.loads(app.make_response(vista.__wrapped__()).get_data())
+                    cuerpo.get('kpi_principal', {}).pop('fecha_calculo', None)
+                    cuerpos.append(cuerpo)
+                assert 'error' not in cuerpos[0] and cuerpos[0] == cuerpos[1], ruta
+        finally:
+            app_modulo.HISTORIA_DIAS, app_modulo.data_cache, app_modulo.orjson = configuracion
+        print("   ✓ orjson: mismas respuestas que json estándar")
+    
+    # Los cuerpos comprimidos cuentan para el presupuesto en bytes de la caché
+    cache = ResponseCache(max_bytes=10 ** 6)
+    cache.version = 'v1'
+    respuesta = cache.get_or_compute('k', lambda: app.response_class(b'x' * 5000))
+    respuesta._clave_cache = 'k'
+    app_modulo.response_cache = cache
+    try:
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            respuesta.mimetype = 'application/json'
+            antes = cache.bytes
+            app_modulo.comprimir_respuesta(respuesta)
+            app_modulo.comprimir_respuesta(respuesta)  # Memoizado: se cuenta una sola vez
+    finally:
+        app_modulo.response_cache = response_cache
+    assert cache.bytes == antes + len(respuesta._comprimidos['gzip'])
+
+def test_batch():
+    """Probar /api/batch contra los endpoints individuales y el filtrado compartido"""
+    print("\n=== PRUEBA DE ENDPOINT BATCH ===")
+    
+    client = app.test_client()
+    filtros = 'fecha_inicio=2024-01-01&segmento=RESIDENCIAL'
+    start_time = time.time()
+    batch = client.get(f'/api/batch?parts=kpis,tendencias,kpi6&{filtros}')
+    batch_time = time.time() - start_time
+    assert batch.status_code == 200
+    datos = batch.get_json()
+    assert set(datos) == {'kpis', 'tendencias', 'kpi6', 'filtros_ignorados'}
+    assert datos['kpis'] == client.get(f'/api/kpis?{filtros}').get_json()
+    assert datos['tendencias'] == client.get('/api/tendencias').get_json()
+    assert datos['kpi6'] == client.get('/api/kpi6/analytics').get_json()
+    # Las partes sin esos filtros lo informan en lugar de devolver datos sin filtrar en silencio
+    assert datos['filtros_ignorados'] == {'tendencias': ['fecha_inicio', 'segmento'],
+                                          'kpi6': ['fecha_inicio', 'segmento']}
+    
+    # KPI 2 recibe la marca común con el nombre de su endpoint
+    kpi2 = client.get('/api/batch?parts=kpi2&marca=ABB').get_json()
+    assert 'filtros_ignorados' not in kpi2
+    assert kpi2['kpi2'] == client.get('/api/kpi2/analytics?marca_medidor=ABB').get_json()
+    
+    assert client.get('/api/batch?parts=kpis,desconocida').status_code == 400
+    
+    df = pd.DataFrame({
+        'fecha_evento': pd.date_range('2024-01-01', periods=10, freq='D'),
+        'segmento': ['A', 'B'] * 5,
+        'consumo_teorico': [0.0, 100.0] * 5,
+        'consumo_reportado': [50.0, 140.0] * 5
+    })
+    filtrado = filtrar_hislec_limpio(df, '2024-01-03', None, 'A')
+    assert filtrar_hislec_limpio(df, '2024-01-03', None, 'A') is filtrado and len(filtrado) == 4
+    assert filtrar_hislec_limpio(df) is df
+    
+    # Columnas derivadas calculadas una vez por DataFrame filtrado
+    filtrado = filtrar_hislec_limpio(df, '2024-01-03', None, 'B')
+    derivadas = columnas_derivadas(filtrado)
+    assert columnas_derivadas(filtrado) is derivadas and derivadas['validos'].all()
+    assert np.allclose(derivadas['divergencia'], 0.4)
+    
+    # Al reemplazar el snapshot se descartan sus filtrados y columnas derivadas
+    olvidar_snapshot(df)
+    assert filtrar_hislec_limpio(df, '2024-01-03', None, 'B') is not filtrado
+    assert all(origen is not filtrado for origen, _ in app_modulo._derivadas.values())
+    
+    # Los filtrados quedan acotados en bytes
+    configuracion = app_modulo.FILTRADOS_MB
+    app_modulo.FILTRADOS_MB = 1e-9
+    try:
+        filtrar_hislec_limpio(df, '2024-01-05', None, 'A')
+        assert not app_modulo._filtrados and app_modulo._filtrados_bytes == 0
+    finally:
+        app_modulo.FILTRADOS_MB = configuracion
+    print(f"   ✓ 3 partes en una request: {batch_time:.3f}s")
+
+def test_stream_eventos():
+    """Probar el canal SSE: evento de versión al conectar y aviso de cambio a todos los suscriptores"""
+    print("\n=== PRUEBA DE SERVER-SENT EVENTS ===")
+    import json
+    
+    def leer_evento(stream):
+        return json.loads(next(stream).decode().split('data: ', 1)[1])
+    
+    client = app.test_client()
+    simple = client.get('/api/stream', buffered=False)
+    con_kpis = client.get('/api/stream?kpis=1', buffered=False)
+    assert simple.mimetype == 'text/event-stream'
+    streams = [iter(simple.response), iter(con_kpis.response)]
+    for stream in streams:
+        assert next(stream).startswith(b'retry')
+        assert 'version' in leer_evento(stream)
+    assert len(difusor.suscriptores) == 2
+    
+    notificar_cambio('hislec_limpio')
+    evento_simple, evento_kpis = [leer_evento(stream) for stream in streams]
+    assert evento_simple['dataset'] == 'hislec_limpio' and 'kpis' not in evento_simple
+    assert evento_kpis['kpis'] == client.get('/api/kpis').get_json()
+    
+    simple.close()
+    con_kpis.close()
+    assert not difusor.suscriptores
+    print(f"   ✓ Cambio de versión {evento_simple['version']} enviado a 2 suscriptores")
+
+def test_stream_tope_conexiones():
+    """Probar que con streams abiertos los threads del worker siguen atendiendo la API"""
+    print("\n=== PRUEBA DE TOPE DE CONEXIONES SSE ===")
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def pedir(url):
+        respuesta = app.test_client().get(url)  # Lee el stream completo, como un thread de gthread
+        return respuesta.status_code, respuesta.headers.get('Retry-After'), respuesta.data
+    
+    threads, tope, abiertos = 6, 3, 6
+    configuracion = (difusor.max_suscriptores, app_modulo.SSE_DURACION, app_modulo.SSE_KEEPALIVE)
+    difusor.max_suscriptores, app_modulo.SSE_DURACION, app_modulo.SSE_KEEPALIVE = tope, 3.0, 0.5
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as worker:
+            streams = [worker.submit(pedir, '/api/stream') for _ in range(abiertos)]
+            inicio = time.time()
+            while len(difusor.suscriptores) < tope and time.time() - inicio < 2:
+                time.sleep(0.01)
+            
+            # Los streams que superan el tope se rechazan y liberan su thread al instante
+            kpis = worker.submit(pedir, '/api/kpis').result(timeout=2)
+            assert kpis[0] == 200
+            assert len(difusor.suscriptores) == tope  # Atendida con los streams todavía abiertos
+            
+            resultados = [stream.result(timeout=10) for stream in streams]
+        rechazados = [r for r in resultados if r[0] == 503]
+        aceptados = [r for r in resultados if r[0] == 200]
+        assert len(rechazados) == abiertos - tope and all(r[1] for r in rechazados)
+        # Los aceptados terminan solos al cumplir su vida máxima, con 'retry' para reconectarse
+        assert len(aceptados) == tope and all(r[2].startswith(b'retry') for r in aceptados)
+        assert not difusor.suscriptores
+    finally:
+        difusor.max_suscriptores, app_modulo.SSE_DURACION, app_modulo.SSE_KEEPALIVE = configuracion
+    print(f"   ✓ /api/kpis atendida con {tope} streams abiertos en {threads} threads; {len(rechazados)} rechazados con 503")
+    
+    # Un stream cuyo cuerpo nunca se recorre (cliente que se va antes del primer byte) libera su lugar
+    client = app.test_client()
+    for _ in range(difusor.max_suscriptores + 2):
+        client.get('/api/stream', buffered=False).close()
+    assert not difusor.suscriptores
+    
+    # HEAD contra un servidor WSGI real no ocupa lugares
+    import http.client
+    import threading
+    from werkzeug.serving import make_server
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        for _ in range(difusor.max_suscriptores + 2):
+            conexion = http.client.HTTPConnection('127.0.0.1', servidor.server_port, timeout=5)
+            conexion.request('HEAD', '/api/stream')
+            assert conexion.getresponse().status == 200
+            conexion.close()
+        assert not difusor.suscriptores
+        conexion = http.client.HTTPConnection('127.0.0.1', servidor.server_port, timeout=5)
+        conexion.request('GET', '/api/stream')
+        respuesta = conexion.getresponse()
+        assert respuesta.status == 200 and respuesta.readline().startswith(b'retry')
+        conexion.close()
+    finally:
+        servidor.shutdown()
+    print(f"   ✓ HEAD y streams no leídos no ocupan lugares ({difusor.max_suscriptores} disponibles)")
+
+def test_rango_fechas():
+    """Probar el filtro de fechas con searchsorted contra las máscaras booleanas"""
+    print("\n=== PRUEBA DE ÍNDICE DE FECHAS ===")
+    
+    rng = np.random.default_rng(20)
+    n = 200000
+    fechas = pd.Series(pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 730, n), unit='D'))
+    fechas[rng.random(n) < 0.05] = pd.NaT
+    desordenado = pd.DataFrame({'fecha_evento': fechas, 'valor': rng.random(n)})
+    ordenado = desordenado.dropna().sort_values('fecha_evento', kind='stable').reset_index(drop=True)
+    
+    for df in (desordenado, ordenado):
+        for inicio, fin in [('2023-03-15', '2024-06-30'), (None, '2023-02-01'), ('2024-12-01', None), ('2026-01-01', None)]:
+            mascara = np.ones(len(df), dtype=bool)
+            if inicio:
+                mascara &= (df['fecha_evento'] >= pd.Timestamp(inicio)).to_numpy()
+            if fin:
+                mascara &= (df['fecha_evento'] <= pd.Timestamp(fin)).to_numpy()
+            pd.testing.assert_frame_equal(filtrar_rango_fechas(df, inicio, fin), df[mascara])
+    
+    start_time = time.time()
+    rango = filtrar_rango_fechas(ordenado, '2023-03-15', '2024-06-30')
+    rango_time = time.time() - start_time
+    assert np.shares_memory(rango['valor'].to_numpy(), ordenado['valor'].to_numpy())  # Slice sin copia
+    print(f"   ✓ {len(rango)} de {len(ordenado)} registros por searchsorted en {rango_time:.4f}s")
+    
+    # El archivo real viene ordenado por medidor: el snapshot se ordena por fecha una vez al cargarlo
+    configuracion = (app_modulo.HISTORIA_DIAS, app_modulo.data_cache)
+    app_modulo.HISTORIA_DIAS, app_modulo.data_cache = 0, DataCache()
+    try:
+        datos = load_optimized_data()
+        assert datos['fecha_evento'].is_monotonic_increasing
+        assert sorted(datos['numero_medidor'].astype(str)) == sorted(pd.read_csv(DATA_LIMPIO, usecols=['numero_medidor'], dtype=str)['numero_medidor'])
+        rango = filtrar_rango_fechas(datos, '2024-03-01', '2024-09-30')
+        assert np.shares_memory(rango['consumo_reportado'].to_numpy(), datos['consumo_reportado'].to_numpy())
+        assert ordenar_por_fecha(datos) is datos
+    finally:
+        app_modulo.HISTORIA_DIAS, app_modulo.data_cache = configuracion
+    print(f"   ✓ hislec_limpio ordenado por fecha: {len(rango)} registros de un rango como slice")
+
+def test_indices_categorias():
+    """Probar la selección por índices de categorías contra las máscaras booleanas"""
+    print("\n=== PRUEBA DE ÍNDICES DE CATEGORÍAS ===")
+    
+    rng = np.random.default_rng(21)
+    n = 200000
+    segmentos = np.array(['RESIDENCIAL', 'COMERCIAL', 'INDUSTRIAL', None], dtype=object)
+    marcas = np.array(['ABB', 'ITRON', 'ELSTER', 'LANDIS'], dtype=object)
+    df = pd.DataFrame({
+        'fecha_evento': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 730, n), unit='D'),
+        'segmento': segmentos[rng.choice(4, n, p=[0.7, 0.2, 0.05, 0.05])],
+        'marca_medidor': marcas[rng.integers(0, 4, n)],
+        'vigente': np.where(rng.random(n) < 0.9, 'S', 'N'),
+        'med_ficticio': np.where(rng.random(n) < 0.02, 'S', 'N'),
+    })
+    
+    casos = [
+        ('2023-03-15', '2024-06-30', {'segmento': 'INDUSTRIAL', 'marca_medidor': 'ABB'}, None),
+        (None, None, {'vigente': 'S'}, None),
+        ('2024-12-01', None, {'vigente': 'S'}, {'med_ficticio': 'S'}),
+        (None, None, None, {'med_ficticio': 'S'}),
+        (None, None, {'segmento': 'NO_EXISTE'}, None),
+    ]
+    for inicio, fin, iguales, distintos in casos:
+        mascara = np.ones(n, dtype=bool)
+        if inicio:
+            mascara &= (df['fecha_evento'] >= pd.Timestamp(inicio)).to_numpy()
+        if fin:
+            mascara &= (df['fecha_evento'] <= pd.Timestamp(fin)).to_numpy()
+        for columna, valor in (iguales or {}).items():
+            mascara &= (df[columna] == valor).to_numpy()
+        for columna, valor in (distintos or {}).items():
+            mascara &= (df[columna] != valor).to_numpy()
+        filas = seleccionar_filas(df, inicio, fin, iguales, distintos)
+        assert np.array_equal(filas, np.flatnonzero(mascara))  # Mismas filas, en orden
+    
+    start_time = time.time()
+    filas = seleccionar_filas(df, '2023-03-15', '2024-06-30', {'segmento': 'INDUSTRIAL', 'marca_medidor': 'ABB'})
+    seleccion_time = time.time() - start_time
+    print(f"   ✓ {len(filas)} de {n} registros por intersección de índices en {seleccion_time:.4f}s")
+    
+    # Al reemplazar el snapshot no quedan índices que retengan el DataFrame anterior
+    olvidar_snapshot(df)
+    assert all(origen is not df for origen, _ in app_modulo._indices_categorias.values())
+    assert all(origen is not df for origen, _ in app_modulo._indices_fechas.values())
+
+def test_tipos_compactos():
+    """Probar el esquema declarado de hislec_limpio: mismos valores que read_csv en menos memoria"""
+    print("\n=== PRUEBA DE TIPOS COMPACTOS ===")
+    
+    columnas = list(HISLEC_LIMPIO_SPEC['dtypes']) + ['fecha_evento']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'hislec_limpio.unl')
+        shutil.copy(DATA_LIMPIO, path)
+        
+        # Una caché construida con otros tipos se reconstruye con el esquema declarado
+        _, anterior = build_columnar_cache(path, ',', {}, HISLEC_LIMPIO_SPEC['date_columns'])
+        _, manifest = build_columnar_cache(path, **HISLEC_LIMPIO_SPEC)
+        assert manifest['generation'] != anterior['generation']
+        assert manifest['columns']['segmento'] == 'category'
+        
+        df = load_columnar(path, columnas, **HISLEC_LIMPIO_SPEC)
+        original = pd.read_csv(DATA_LIMPIO, usecols=columnas)[columnas]
+        original['fecha_evento'] = pd.to_datetime(original['fecha_evento'], format='%d/%m/%Y', errors='coerce')
+        
+        assert df['constante'].dtype == 'float32'
+        assert isinstance(df['segmento'].dtype, pd.CategoricalDtype)
+        assert isinstance(df['numero_medidor'].dtype, pd.CategoricalDtype)
+        assert df['numero_medidor'].cat.codes.dtype.itemsize <= 4
+        pd.testing.assert_frame_equal(df.astype(original.dtypes.to_dict()), original, check_exact=False, rtol=1e-6)
+        
+        memoria = reportar_memoria('hislec_limpio', df)
+        antes = original.memory_usage(deep=True, index=False).sum()
+        assert memoria.sum() < antes
+        print(f"   ✓ {antes / 1e3:.1f} KB con read_csv → {memoria.sum() / 1e3:.1f} KB con el esquema declarado")
+        
+        # Ids de medidor en blanco, no numéricos o fuera de int32 no rompen la carga
+        with open(DATA_LIMPIO) as f:
+            contenido = f.read()
+        resto = contenido.split('\n')[1].split(',', 1)[1]
+        with open(path, 'a') as f:
+            f.write('' if contenido.endswith('\n') else '\n')
+            f.writelines([f",{resto}\n", f"MED-0042,{resto}\n", f"{2 ** 31 + 5},{resto}\n"])
+        df = load_columnar(path, columnas, **HISLEC_LIMPIO_SPEC)
+        assert len(df) == len(original) + 3
+        medidores = df['numero_medidor'].iloc[-3:].tolist()
+        assert pd.isna(medidores[0]) and medidores[1:] == ['MED-0042', str(2 ** 31 + 5)]
+    print("   ✓ Ids de medidor malformados cargados como categorías")
+
+def test_fechas_unicas():
+    """Probar el parseo de fechas por valor distinto y su almacenamiento como números de día"""
+    print("\n=== PRUEBA DE PARSEO DE FECHAS ===")
+    
+    rng = np.random.default_rng(23)
+    fechas = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3650, 300000), unit='D')
+    serie = pd.Series(np.asarray(fechas.strftime('%d/%m/%Y'), dtype=object))
+    serie[::97] = None
+    serie[5] = '31/02/2024'  # Fecha inválida → NaT
+    
+    start_time = time.time()
+    esperado = pd.to_datetime(serie, format='%d/%m/%Y', errors='coerce')
+    to_datetime_time = time.time() - start_time
+    start_time = time.time()
+    parseado = parsear_fechas(serie, '%d/%m/%Y')
+    parseo_time = time.time() - start_time
+    pd.testing.assert_series_equal(parseado, esperado)
+    print(f"   ✓ {serie.nunique()} fechas distintas: to_datetime {to_datetime_time:.3f}s, por valor único {parseo_time:.3f}s")
+    
+    _, manifest = build_columnar_cache(DATA_TOTAL, **HISLEC_TOTAL_SPEC)
+    assert manifest['columns']['fecha_evento'] == 'date'
+    df = load_columnar(DATA_TOTAL, ['fecha_evento'], **HISLEC_TOTAL_SPEC)
+    original = pd.read_csv(DATA_TOTAL, delimiter='|', usecols=['fecha_evento'])
+    pd.testing.assert_series_equal(df['fecha_evento'], pd.to_datetime(original['fecha_evento'], format='%d/%m/%Y', errors='coerce'))
+    print(f"   ✓ fecha_evento guardada como número de día: {df['fecha_evento'].isna().sum()} NaT preservados")
+
+def test_parseo_paralelo():
+    """Probar el parseo por rangos de bytes en procesos contra un único read_csv"""
+    print("\n=== PRUEBA DE PARSEO PARALELO ===")
+    
+    with open(DATA_TOTAL, 'rb') as f:
+        f.readline()
+        inicio = f.tell()
+    rangos = rangos_de_lineas(DATA_TOTAL, inicio, os.path.getsize(DATA_TOTAL), 7)
+    with open(DATA_TOTAL, 'rb') as f:
+        contenido = f.read()
+    assert rangos[0][0] == inicio and rangos[-1][1] == len(contenido)
+    assert all(contenido[desde - 1:desde] == b'\n' for desde, _ in rangos)  # Cada rango empieza en una línea
+    
+    workers, umbral = app_modulo.PARSEO_WORKERS, app_modulo.PARSEO_PARALELO_MB
+    app_modulo.PARSEO_WORKERS, app_modulo.PARSEO_PARALELO_MB = 3, 0
+    try:
+        for path, spec in ((DATA_TOTAL, HISLEC_TOTAL_SPEC), (DATA_LIMPIO, HISLEC_LIMPIO_SPEC)):
+            start_time = time.time()
+            paralelo, columnas_paralelo = parse_unl_paralelo(path, **spec)
+            paralelo_time = time.time() - start_time
+            esperado, columnas = _parse_unl(path, **spec)
+            assert columnas_paralelo == columnas
+            pd.testing.assert_frame_equal(paralelo, esperado)
+            print(f"   ✓ {os.path.basename(path)}: {len(paralelo)} registros en 3 procesos ({paralelo_time:.2f}s)")
+    finally:
+        app_modulo.PARSEO_WORKERS, app_modulo.PARSEO_PARALELO_MB = workers, umbral
+    
+    # Por defecto, las CPUs asignadas al proceso (no las del host) con un máximo de 4
+    assert 1 <= app_modulo.cpus_disponibles() <= (os.cpu_count() or 1)
+    if 'DASHBOARD_PARSE_WORKERS' not in os.environ:
+        assert workers == min(app_modulo.cpus_disponibles(), 4)
+    print(f"   ✓ {workers} procesos por defecto con {app_modulo.cpus_disponibles()} CPUs disponibles")
+
+def test_motores_csv():
+    """Comparar los motores de parseo disponibles (mismo resultado) e informar la aceleración de cada uno"""
+    print("\n=== PRUEBA DE MOTORES CSV ===")
+    
+    # Si pyarrow se fija en requirements.txt, la comparación debe correr (no saltarse)
+    with open(os.path.join(os.path.dirname(DATA_TOTAL), '..', 'requirements.txt')) as f:
+        fijado = any(linea.lower().startswith('pyarrow') for linea in f)
+    assert app_modulo.pyarrow is not None or not fijado, "pyarrow está en requirements.txt pero no instalado"
+    assert app_modulo.motor_csv() == 'c'  # pyarrow solo si se pide con DASHBOARD_CSV_ENGINE
+    
+    motores = ['c'] + (['pyarrow'] if app_modulo.pyarrow is not None else [])
+    if app_modulo.pyarrow is None:
+        print("   pyarrow no está instalado: solo se mide el motor C de pandas")
+    for path, spec in ((DATA_TOTAL, HISLEC_TOTAL_SPEC), (DATA_LIMPIO, HISLEC_LIMPIO_SPEC)):
+        tiempos = {}
+        resultados = {}
+        for motor in motores:
+            start_time = time.time()
+            resultados[motor], _ = _parse_unl(path, engine=motor, **spec)
+            tiempos[motor] = time.time() - start_time
+        base = resultados['c']
+        assert list(base.columns) == [c for c in pd.read_csv(path, delimiter=spec['delimiter'], nrows=0).columns
+                                      if c in spec['usecols']]
+        
+        # Registros agregados y tramos: buffer sin encabezado con los nombres del archivo
+        with open(path, 'rb') as f:
+            f.readline()
+            cuerpo = f.read()
+        names = app_modulo.encabezado_unl(path, spec['delimiter'])
+        for motor in motores:
+            pd.testing.assert_frame_equal(resultados[motor], base, check_exact=False)
+            buffer, _ = _parse_unl(io.BytesIO(cuerpo), spec['delimiter'], spec['dtypes'], spec['date_columns'],
+                                   names, spec['usecols'], engine=motor)
+            pd.testing.assert_frame_equal(buffer, base, check_exact=False)
+            print(f"   ✓ {os.path.basename(path)} [{motor}]: {tiempos[motor]:.3f}s "
+                  f"(x{tiempos['c'] / max(tiempos[motor], 1e-9):.1f} frente al motor C)")
+
 if __name__ == "__main__":
     try:
         # Probar carga de datos
@@ -80,6 +1163,35 @@ if __name__ == "__main__":
         # Probar sistema de caché
         test_cache_system()
         
+        # Probar caché columnar
+        test_columnar_cache()
+        test_dataset_version()
+        test_incremental_ingest()
+        test_clasificador_estimadas()
+        test_continuidad_kpi6()
+        test_cubo_mensual()
+        test_kpis_exactos()
+        test_cifras_desde_cubo()
+        test_quantile_sketch()
+        test_tendencias_una_pasada()
+        test_agregar_por_categoria()
+        test_cache_compartida()
+        test_response_cache()
+        test_recarga_snapshots()
+        test_ventana_historia()
+        test_stale_while_revalidate()
+        test_etag_condicional()
+        test_json_comprimido()
+        test_batch()
+        test_stream_eventos()
+        test_stream_tope_conexiones()
+        test_rango_fechas()
+        test_indices_categorias()
+        test_tipos_compactos()
+        test_fechas_unicas()
+        test_parseo_paralelo()
+        test_motores_csv()
+        
         print("\n=== RESUMEN ===")
         print("✓ Todas las optimizaciones están funcionando correctamente")
         print("✓ Sistema listo para uso en producción")